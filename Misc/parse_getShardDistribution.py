@@ -2,6 +2,58 @@ import re
 import sys
 import json
 
+try:
+    import orjson
+
+    def _dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj, indent=2)
+
+_DATA_UNIT = re.compile(r'([\d.]+)([A-Za-z]+)')
+
+def _iter_sections(text):
+    # Yield one shard section at a time (header line first), without building a list
+    marker = '\nShard '
+    text = '\n' + text.strip()
+    start = text.find(marker)
+    while start != -1:
+        nxt = text.find(marker, start + 1)
+        yield text[start + len(marker):nxt if nxt != -1 else None]
+        start = nxt
+
+def _parse_pairs(data):
+    # Parse the JSON-like data, removing curly braces
+    data = data.rstrip().strip('{}')
+
+    # Parse key-value pairs
+    pairs = {}
+    for line in data.split(',\n'):
+        line = line.strip()
+        if not line:
+            continue
+        key, _, value = line.partition(': ')
+        # Clean up the key and value
+        key = key.strip("'")
+        value = value.strip("'")
+
+        # Special handling for data field to separate units
+        if key == 'data':
+            match = _DATA_UNIT.match(value)
+            if match:
+                pairs['data'] = match.group(1)
+                pairs['dataUnits'] = match.group(2)
+            continue
+
+        # Convert numeric values where appropriate
+        if 'docs' == key or 'chunks' == key:
+            value = int(value)
+
+        pairs[key] = value
+
+    return pairs
+
 def parse_shard_distribution(raw_text):
     """
     Parse MongoDB's getShardDistribution() output into a dictionary.
@@ -15,54 +67,16 @@ def parse_shard_distribution(raw_text):
         dict: Dictionary with shard names as keys and their stats as values
     """
     # Stop at "Totals" line
-    content = raw_text.split('\nTotals')[0]
-    
-    # Split the input into sections (one per shard)
-    sections = re.split(r'\nShard ', content.strip())
-    if sections[0].startswith('Shard '):
-        sections[0] = sections[0][6:]  # Remove 'Shard ' from first section
+    content = raw_text.partition('\nTotals')[0]
     
     result = {}
-    
-    for section in sections:
-        # Parse each section
-        lines = section.strip().split('\n')
-        
-        # Extract shard name from the first line
-        shard_name = lines[0].split(' at ')[0]
-        
-        # Parse the JSON-like data
-        data_lines = '\n'.join(lines[1:])  # Join remaining lines
-        # Remove curly braces
-        data_lines = data_lines.strip('{}')
-        
-        # Parse key-value pairs
-        pairs = {}
-        for line in data_lines.split(',\n'):
-            line = line.strip()
-            if not line:
-                continue
-            key, value = line.split(': ', 1)
-            # Clean up the key and value
-            key = key.strip("'")
-            value = value.strip("'")
-            
-            # Special handling for data field to separate units
-            if key == 'data':
-                match = re.match(r'([\d.]+)(\w+)', value)
-                if match:
-                    pairs['data'] = match.group(1)
-                    pairs['dataUnits'] = match.group(2)
-                continue
-            
-            # Convert numeric values where appropriate
-            if 'docs' == key or 'chunks' == key:
-                value = int(value)
-            
-            pairs[key] = value
-            
-        result[shard_name] = pairs
-    
+
+    for section in _iter_sections(content):
+        header, _, data = section.partition('\n')
+        # Extract shard name from the header line
+        shard_name = header.partition(' at ')[0]
+        result[shard_name] = _parse_pairs(data)
+
     return result
 
 if __name__ == "__main__":
@@ -73,4 +87,4 @@ if __name__ == "__main__":
     result = parse_shard_distribution(input_data)
     
     # Print the result as JSON
-    print(json.dumps(result, indent=2))
\ No newline at end of file
+    sys.stdout.write(_dumps(result) + '\n')
\ No newline at end of file
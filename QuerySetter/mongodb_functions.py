@@ -1,19 +1,64 @@
 from pymongo import MongoClient
-from uuid import uuid4
-from collections import defaultdict
 from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
 from datetime import datetime
+import base64
+import bson
 import traceback
 import logging
 import hashlib
 import json
-import re
+
+try:
+    import orjson
+
+    def _json_str(obj):
+        return orjson.dumps(obj).decode()
+
+    def _shape_json(obj):
+        return orjson.dumps(obj, default=str)
+except ImportError:
+    def _json_str(obj):
+        return json.dumps(obj)
+
+    def _shape_json(obj):
+        return json.dumps(obj, default=str).encode()
 
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Without the C extensions, BSON decoding of $queryStats and explain output is several times slower
+if not bson.has_c():
+    logger.warning("PyMongo's bson C extension is not available; BSON decoding will be slow")
+
+# Documents per cursor batch for the admin aggregations, to cut getMore round trips
+AGGREGATE_BATCH_SIZE = 1000
+# Most $queryStats entries fetched for one namespace (the most executed shapes are kept)
+NAMESPACE_QUERY_STATS_LIMIT = 5000
+
+# Shared representative values for date/objectId placeholders; both types are immutable
+_REP_DATE = datetime(2024, 1, 1)
+_REP_OID = ObjectId("000000000000000000000000")
+
+# Query shape placeholder -> representative value. The values are shared between
+# calls; nothing downstream mutates them (they are only encoded or rendered).
+_REP_VALUES = {
+    '?number': 1,
+    '?string': "a",
+    '?date': _REP_DATE,
+    '?objectId': _REP_OID,
+    '?bool': True,
+    '?null': None,
+    '?object': {"a": 1},
+    '?binData': b'binary_data',
+    '?timestamp': _REP_DATE,
+    '?minKey': {"$minKey": 1},
+    '?maxKey': {"$maxKey": 1},
+}
+_REP_VALUES.update({f"?array<{placeholder}>": [value] for placeholder, value in list(_REP_VALUES.items())})
+
 def safe_execute(func):
     def wrapper(*args, **kwargs):
         try:
@@ -21,7 +66,8 @@ def safe_execute(func):
         except Exception as e:
             error_msg = f"Error in {func.__name__}: {str(e)}"
             logger.error(error_msg)
-            logger.error(traceback.format_exc())
+            # The traceback is only formatted when debug logging is enabled
+            logger.debug("Traceback for %s", func.__name__, exc_info=True)
             return None
     return wrapper
 
@@ -38,34 +84,62 @@ def get_debug_query_shapes(client, db_name, coll_name):
         {"$querySettings": {"showDebugQueryShape": True}},
         {"$match": {"debugQueryShape.cmdNs.db": db_name, "debugQueryShape.cmdNs.coll": coll_name}}
     ]
-    return list(admin_db.aggregate(pipeline))
-
-@safe_execute
-def get_stages_r(o, arr):
-    if o and 'queryPlanner' in o:
-        get_stages_r(o['queryPlanner'], arr)
-    elif o and 'winningPlan' in o:
-        get_stages_r(o['winningPlan'], arr)
-    elif o and 'queryPlan' in o:
-        get_stages_r(o['queryPlan'], arr)
-    elif o and 'stage' in o:
-        arr.insert(0, o['stage'])
-        if 'inputStage' in o:
-            get_stages_r(o['inputStage'], arr)
-        elif 'inputStages' in o:
-            for e in o['inputStages']:
-                get_stages_r(e, arr)
-    elif o and 'stages' in o and o['stages'] and '$cursor' in o['stages'][0]:
-        get_stages_r(o['stages'][0]['$cursor'], arr)
+    return list(admin_db.aggregate(pipeline, batchSize=AGGREGATE_BATCH_SIZE))
 
 @safe_execute
 def get_plan_stages(plan):
+    # Iterative walk of the plan tree; sibling inputStages wait on the stack
     arr = []
-    get_stages_r(plan, arr)
+    stack = [plan]
+    while stack:
+        node = stack.pop()
+        while node:
+            # 'stage' is checked first since most plan nodes are stage nodes
+            if 'stage' in node:
+                arr.append(node['stage'])
+                if 'inputStage' in node:
+                    node = node['inputStage']
+                else:
+                    if 'inputStages' in node:
+                        stack.extend(reversed(node['inputStages']))
+                    node = None
+            elif 'queryPlanner' in node:
+                node = node['queryPlanner']
+            elif 'winningPlan' in node:
+                node = node['winningPlan']
+            elif 'queryPlan' in node:
+                node = node['queryPlan']
+            else:
+                stages = node.get('stages')
+                node = stages[0].get('$cursor') if stages else None
+    # Stages were collected root-first; report them in execution order
+    arr.reverse()
     return arr
 
+# Fixed $queryStats pipeline stages, BSON-encoded once at import
+_QUERY_STATS_STAGE = RawBSONDocument(bson.encode({"$queryStats": {}}))
+_MATCH_STAGE = RawBSONDocument(bson.encode({
+    "$match": {"key.queryShape.cmdNs.db": {"$nin": ["admin", "config", "local"]}}
+}))
+# Only the fields the app reads are sent back over the wire
+_PROJECT_STAGE = RawBSONDocument(bson.encode({
+    "$project": {"key.queryShape": 1, "key.client": 1, "metrics": 1, "queryShapeHash": 1}
+}))
+# Per-namespace entry counts are all the namespace selector needs. Grouping on the
+# cmdNs document keeps db and coll apart, since collection names may contain dots.
+_NAMESPACE_COUNT_STAGE = RawBSONDocument(bson.encode({
+    "$group": {"_id": "$key.queryShape.cmdNs", "count": {"$sum": 1}}
+}))
+_SORT_STAGE = RawBSONDocument(bson.encode({"$sort": {"_id.db": 1, "_id.coll": 1}}))
+# keyHash breaks execCount ties so the same entries come back in the same order
+_EXEC_COUNT_SORT_STAGE = RawBSONDocument(bson.encode({"$sort": {"metrics.execCount": -1, "keyHash": 1}}))
+
 @safe_execute
 def get_query_stats(client):
+    """
+    Summarize $queryStats as {(db, coll): entry count}, sorted by namespace.
+    Entries for a namespace are fetched on demand with get_namespace_query_stats.
+    """
     # Check the internalQueryStatsRateLimit parameter
     param_state = client.admin.command({'getParameter': 1, 'internalQueryStatsRateLimit': 1})
     rate_limit = param_state.get('internalQueryStatsRateLimit')
@@ -73,27 +147,15 @@ def get_query_stats(client):
     if rate_limit == 0:
         return {"error": "rate_limit_zero"}
 
-    MATCH_STAGE = {
-        "$match": {"key.queryShape.cmdNs.db": {"$nin": ["admin", "config", "local"]}}
-    }
-    SORT_STAGE = {
-        "$sort": {"key.queryShape.cmdNs.db": 1, "key.queryShape.cmdNs.coll": 1}
-    }
-
     admin_db = client['admin']
     cursor = admin_db.aggregate([
-        {"$queryStats": {}},
-        MATCH_STAGE,
-        SORT_STAGE
-    ])
-
-    query_stats = defaultdict(list)
-    for doc in cursor:
-        query_shape = doc['key']['queryShape']
-        db_name = query_shape['cmdNs']['db']
-        coll_name = query_shape['cmdNs']['coll']
-        namespace = f"{db_name}.{coll_name}"
-        query_stats[namespace].append(doc)
+        _QUERY_STATS_STAGE,
+        _MATCH_STAGE,
+        _NAMESPACE_COUNT_STAGE,
+        _SORT_STAGE
+    ], batchSize=AGGREGATE_BATCH_SIZE)
+
+    query_stats = {(doc['_id']['db'], doc['_id']['coll']): doc['count'] for doc in cursor}
 
     if not query_stats:
         return {"error": "empty_query_stats"}
@@ -101,31 +163,26 @@ def get_query_stats(client):
     return query_stats
 
 @safe_execute
-def get_indexes(client, namespace):
-    db_name, coll_name = namespace.split('.')
-    return list(client[db_name][coll_name].list_indexes())
+def get_namespace_query_stats(client, db_name, coll_name, limit=NAMESPACE_QUERY_STATS_LIMIT):
+    # Filter and cap on the server so only the selected namespace's busiest entries are sent back
+    admin_db = client['admin']
+    return list(admin_db.aggregate([
+        _QUERY_STATS_STAGE,
+        {"$match": {"key.queryShape.cmdNs.db": db_name, "key.queryShape.cmdNs.coll": coll_name}},
+        _EXEC_COUNT_SORT_STAGE,
+        {"$limit": limit},
+        _PROJECT_STAGE
+    ], batchSize=AGGREGATE_BATCH_SIZE, allowDiskUse=True))
 
 @safe_execute
-def get_index_info(client, db_name, coll_name, index_name):
-    db = client[db_name]
-    coll = db[coll_name]
-    indexes = list(coll.list_indexes())
-    for index in indexes:
-        if index['name'] == index_name:
-            return index
-    return None
-
-import traceback
-import json
-
-import traceback
-import json
+def get_indexes(client, db_name, coll_name):
+    return list(client[db_name][coll_name].list_indexes())
 
 @safe_execute
-def get_explain_plan(client, entry):
-    query_shape = entry['key']['queryShape']
-    db_name = query_shape['cmdNs']['db']
-    coll_name = query_shape['cmdNs']['coll']
+def get_explain_plan(client, query_shape):
+    cmd_ns = query_shape['cmdNs']
+    db_name = cmd_ns['db']
+    coll_name = cmd_ns['coll']
     command = query_shape['command']
     coll = client[db_name][coll_name]
 
@@ -155,184 +212,179 @@ def get_explain_plan(client, entry):
     except Exception as e:
         print(f"Error executing explain for {command}:")
         print(f"Error message: {str(e)}")
-        print(f"Query shape: {json.dumps(query_shape, indent=2)}")
+        print(f"Query shape: {json.dumps(query_shape, indent=2, default=str)}")
         if command == "find":
-            print(f"Representative query: {json.dumps(rep_query, indent=2)}")
-            print(f"Sort specification: {json.dumps(sort_spec, indent=2)}")
+            print(f"Representative query: {json.dumps(rep_query, indent=2, default=str)}")
+            print(f"Sort specification: {json.dumps(sort_spec, indent=2, default=str)}")
         elif command == "aggregate":
-            print(f"Representative pipeline: {json.dumps(rep_pipeline, indent=2)}")
+            print(f"Representative pipeline: {json.dumps(rep_pipeline, indent=2, default=str)}")
         print(f"Traceback: {traceback.format_exc()}")
         return None
     
-@safe_execute
-def simplify_filter(filter_doc):
-    if isinstance(filter_doc, dict):
-        simplified = {}
-        for key, value in filter_doc.items():
-            if key == '$and' or key == '$or':
-                simplified[key] = [simplify_filter(item) for item in filter_doc[key]]
-            elif isinstance(value, dict) and any(k.startswith('$') for k in value.keys()):
-                op = next(k for k in value.keys() if k.startswith('$'))
-                simplified[key] = op  # Keep the operator for later analysis
-            elif isinstance(value, str) and value.startswith('?'):
-                simplified[key] = '$eq'  # Treat as equality
-            else:
-                simplified[key] = simplify_filter(value)
-        return simplified
-    elif isinstance(filter_doc, list):
-        return [simplify_filter(item) for item in filter_doc]
-    else:
-        return filter_doc
+# Operators whose array members are sub-filters rather than field conditions
+_LOGICAL_OPS = frozenset(('$and', '$or'))
+
+def _walk_filter(doc):
+    # Pre-order walk of a filter yielding (field, is_equality) for every field
+    # condition. A condition document is classified by its first operator and a
+    # placeholder value counts as equality; $and/$or only contribute their members.
+    # List items carry a None key so they are not reported as fields.
+    stack = [(None, doc)]
+    while stack:
+        key, value = stack.pop()
+        t = type(value)
+        if key is not None and key not in _LOGICAL_OPS:
+            if t is dict:
+                op = None
+                for k in value:
+                    if k.startswith('$'):
+                        op = k
+                        break
+                if op is not None:
+                    yield key, op == '$eq'
+                    continue
+            elif t is str and value.startswith('?'):
+                yield key, True
+                continue
+            yield key, value == '$eq'
+        if t is dict:
+            stack.extend(reversed(list(value.items())))
+        elif t is list:
+            stack.extend((None, item) for item in reversed(value))
 
-@safe_execute
-def extract_fields(doc):
-    fields = []
-    if isinstance(doc, dict):
-        for key, value in doc.items():
-            if key not in ['$and', '$or']:
-                fields.append((key, value))
-            fields.extend(extract_fields(value))
-    elif isinstance(doc, list):
-        for item in doc:
-            fields.extend(extract_fields(item))
-    return fields
-
-@safe_execute
 def suggest_index(filter_doc, sort_doc):
-    simplified_filter = simplify_filter(filter_doc)
-    equality_fields = []
-    range_fields = []
-    
-    for field, value in extract_fields(simplified_filter):
-        if field not in equality_fields and field not in range_fields:
-            if value == '$eq':
-                equality_fields.append(field)
-            else:
-                range_fields.append(field)
-    
-    sort_fields = list(sort_doc.keys()) if sort_doc else []
-    
-    # Remove duplicate fields
-    sort_fields = [field for field in sort_fields if field not in equality_fields and field not in range_fields]
-    
+    # Field -> whether its first occurrence is an equality match; one lookup per field
+    field_kinds = {}
+    for field, is_equality in _walk_filter(filter_doc):
+        field_kinds.setdefault(field, is_equality)
+
+    # Sort fields already used by the filter are not repeated
+    sort_fields = [field for field in sort_doc if field not in field_kinds] if sort_doc else []
+
     # Combine fields according to Equality, Sort, Range rule
-    suggested_index = {}
-    for field in equality_fields + sort_fields + range_fields:
-        suggested_index[field] = 1
-    
+    suggested_index = {field: 1 for field, is_equality in field_kinds.items() if is_equality}
+    suggested_index.update((field, 1) for field in sort_fields)
+    suggested_index.update((field, 1) for field, is_equality in field_kinds.items() if not is_equality)
+
     return suggested_index
 
-@safe_execute
 def has_collscan(stages):
-    return any('COLLSCAN' in stage for stage in stages)
-
-from bson import ObjectId
-from datetime import datetime
+    # Stage names are exact, so plain membership works for a list or a set
+    return 'COLLSCAN' in stages
+
+def _rep_value(placeholder):
+    # Exact placeholders come from the table; any other ?array<...> form, such as the
+    # mixed-type ?array<> or nested ?array<?array<?number>>, still becomes a list
+    rep = _REP_VALUES.get(placeholder, placeholder)
+    if rep is placeholder and placeholder.startswith('?array<') and placeholder.endswith('>'):
+        inner = placeholder[7:-1]
+        return [_rep_value(inner)] if inner else []
+    return rep  # Keep other placeholders as is
 
-@safe_execute
 def create_representative_query(query_doc):
-    def replace_placeholder(value):
-        if isinstance(value, str) and value.startswith('?'):
-            if value == '?number':
-                return 1
-            elif value == '?string':
-                return "a"
-            elif value == '?date':
-                return datetime.utcnow()
-            elif value == '?objectId':
-                return ObjectId()
-            elif value == '?bool':
-                return True
-            elif value == '?null':
-                return None
-            elif value == '?object':
-                return {"a": 1}
-            elif value == '?binData':
-                return b'binary_data'
-            elif value == '?timestamp':
-                return datetime.utcnow()
-            elif value == '?minKey':
-                return {"$minKey": 1}
-            elif value == '?maxKey':
-                return {"$maxKey": 1}
-            elif value.startswith('?array'):
-                inner_type = value[6:-1]  # extract type inside array
-                return [replace_placeholder(f"?{inner_type}")]
-            else:
-                return value  # Keep other placeholders as is
-        return value
-
-    def traverse(obj):
-        if isinstance(obj, dict):
-            return {k: traverse(v) for k, v in obj.items()}
-        elif isinstance(obj, list):
-            return [traverse(item) for item in obj]
+    # Copy the document top-down: containers are created empty and attached
+    # to their parent slot, scalars are replaced in place
+    root = [None]
+    stack = [(root, 0, query_doc)]
+    while stack:
+        parent, slot, node = stack.pop()
+        t = type(node)
+        if t is dict:
+            copied = parent[slot] = dict.fromkeys(node)
+            items = node.items()
+        elif t is list:
+            copied = parent[slot] = [None] * len(node)
+            items = enumerate(node)
         else:
-            return replace_placeholder(obj)
-
-    return traverse(query_doc)
-
-@safe_execute
-def transform_to_mongosh(query):
-    def transform(value):
-        if isinstance(value, dict):
-            if '$date' in value:
-                return f'ISODate("{value["$date"]}")'
-            elif '$oid' in value:
-                return f'ObjectId("{value["$oid"]}")'
-            elif '$binary' in value:
-                return f'BinData({int(value["$binary"]["subType"], 16)}, "{value["$binary"]["base64"]}")'
-            elif '$timestamp' in value:
-                return f'Timestamp({value["$timestamp"]["t"]}, {value["$timestamp"]["i"]})'
-            elif '$minKey' in value:
-                return 'MinKey()'
-            elif '$maxKey' in value:
-                return 'MaxKey()'
+            parent[slot] = _rep_value(node) if t is str else node
+            continue
+        for key, value in items:
+            vt = type(value)
+            if vt is dict or vt is list:
+                stack.append((copied, key, value))
             else:
-                return {k: transform(v) for k, v in value.items()}
-        elif isinstance(value, list):
-            return [transform(item) for item in value]
-        else:
-            return value
-
-    return transform(query)
-
-import json
+                copied[key] = _rep_value(value) if vt is str else value
+    return root[0]
+
+def _mongosh_literal(value):
+    # mongosh constructor for an extended-JSON type wrapper, or None for plain documents
+    if '$date' in value:
+        return f'ISODate("{value["$date"]}")'
+    elif '$oid' in value:
+        return f'ObjectId("{value["$oid"]}")'
+    elif '$binary' in value:
+        return f'BinData({int(value["$binary"]["subType"], 16)}, "{value["$binary"]["base64"]}")'
+    elif '$timestamp' in value:
+        return f'Timestamp({value["$timestamp"]["t"]}, {value["$timestamp"]["i"]})'
+    elif '$minKey' in value:
+        return 'MinKey()'
+    elif '$maxKey' in value:
+        return 'MaxKey()'
+    return None
 
-@safe_execute
-def stringify_for_mongosh(obj, indent=0):
+def _write_mongosh(obj, indent, parts):
+    # Append mongosh text fragments for obj to parts; joined once by the caller
     if isinstance(obj, dict):
         if not obj:
-            return "{}"
-        lines = ["{"]
+            parts.append("{}")
+            return
+        literal = _mongosh_literal(obj)
+        if literal is not None:
+            parts.append(literal)
+            return
+        parts.append("{")
+        pad = ' ' * (indent + 2)
+        sep = "\n"
         for k, v in obj.items():
-            lines.append(f"{' ' * (indent + 2)}{stringify_for_mongosh(k)}: {stringify_for_mongosh(v, indent + 2)},")
-        lines[-1] = lines[-1].rstrip(',')  # Remove trailing comma from last item
-        lines.append(f"{' ' * indent}}}")
-        return "\n".join(lines)
+            parts.append(sep)
+            parts.append(pad)
+            _write_mongosh(k, 0, parts)
+            parts.append(": ")
+            _write_mongosh(v, indent + 2, parts)
+            sep = ",\n"  # No trailing comma after the last item
+        parts.append("\n")
+        parts.append(' ' * indent)
+        parts.append("}")
     elif isinstance(obj, list):
         if not obj:
-            return "[]"
-        lines = ["["]
+            parts.append("[]")
+            return
+        parts.append("[")
+        pad = ' ' * (indent + 2)
+        sep = "\n"
         for item in obj:
-            lines.append(f"{' ' * (indent + 2)}{stringify_for_mongosh(item, indent + 2)},")
-        lines[-1] = lines[-1].rstrip(',')  # Remove trailing comma from last item
-        lines.append(f"{' ' * indent}]")
-        return "\n".join(lines)
+            parts.append(sep)
+            parts.append(pad)
+            _write_mongosh(item, indent + 2, parts)
+            sep = ",\n"
+        parts.append("\n")
+        parts.append(' ' * indent)
+        parts.append("]")
     elif isinstance(obj, str):
         if obj.startswith('ISODate(') or obj.startswith('ObjectId(') or obj.startswith('BinData(') or \
            obj.startswith('Timestamp(') or obj == 'MinKey()' or obj == 'MaxKey()':
-            return obj
+            parts.append(obj)
         else:
-            return json.dumps(obj)
+            parts.append(_json_str(obj))
     elif obj is None:
-        return 'null'
+        parts.append('null')
     elif isinstance(obj, bool):
-        return 'true' if obj else 'false'
+        parts.append('true' if obj else 'false')
+    elif isinstance(obj, datetime):
+        iso = obj.isoformat(timespec='milliseconds')
+        parts.append(f'ISODate("{iso}Z")' if obj.tzinfo is None else f'ISODate("{iso}")')
+    elif isinstance(obj, ObjectId):
+        parts.append(f'ObjectId("{obj}")')
+    elif isinstance(obj, bytes):
+        parts.append(f'BinData(0, "{base64.b64encode(obj).decode()}")')
     else:
-        return str(obj)
+        parts.append(str(obj))
+
+def stringify_for_mongosh(obj, indent=0):
+    parts = []
+    _write_mongosh(obj, indent, parts)
+    return "".join(parts)
 
-@safe_execute
 def create_rejection_filter(query_shape, rep_query):
     command = query_shape.get('command', 'Unknown')
     db_name = query_shape['cmdNs']['db']
@@ -349,14 +401,12 @@ def create_rejection_filter(query_shape, rep_query):
         }
     }
 
-    # Transform the representative query to mongosh format
-    transformed_query = transform_to_mongosh(rep_query)
-
-    # Determine whether to use 'filter' or 'pipeline' based on rep_query type
-    if isinstance(transformed_query, list):
-        rejection_filter["setQuerySettings"]["pipeline"] = transformed_query
+    # Determine whether to use 'filter' or 'pipeline' based on rep_query type;
+    # BSON values are rendered as mongosh literals when the command is written out
+    if isinstance(rep_query, list):
+        rejection_filter["setQuerySettings"]["pipeline"] = rep_query
     else:
-        rejection_filter["setQuerySettings"]["filter"] = transformed_query
+        rejection_filter["setQuerySettings"]["filter"] = rep_query
 
     if sort:
         rejection_filter["setQuerySettings"]["sort"] = sort
@@ -364,69 +414,83 @@ def create_rejection_filter(query_shape, rep_query):
     # Convert the rejection filter to a pretty-printed mongosh-compatible string
     return f"db.adminCommand(\n{stringify_for_mongosh(rejection_filter, indent=2)}\n)"
 
-    # Transform the representative query to mongosh format
-    transformed_query = transform_to_mongosh(rep_query)
-
-    # Determine whether to use 'filter' or 'pipeline' based on rep_query type
-    if isinstance(transformed_query, list):
-        rejection_filter["setQuerySettings"]["pipeline"] = transformed_query
-    else:
-        rejection_filter["setQuerySettings"]["filter"] = transformed_query
-
-    if sort:
-        rejection_filter["setQuerySettings"]["sort"] = sort
-
-    # Convert the rejection filter to a mongosh-compatible string
-    return f"db.adminCommand({stringify_for_mongosh(rejection_filter)})"
-
-@safe_execute
 def extract_index_names(plan):
+    # Only containers are pushed; scalar values can never hold an indexName
     index_names = set()
-    
-    def traverse_plan(node):
-        if isinstance(node, dict):
-            if 'indexName' in node:
-                index_names.add(node['indexName'])
-            for value in node.values():
-                traverse_plan(value)
-        elif isinstance(node, list):
-            for item in node:
-                traverse_plan(item)
-    
-    traverse_plan(plan)
+    stack = [plan]
+    while stack:
+        node = stack.pop()
+        if type(node) is dict:
+            index_name = node.get('indexName')
+            if index_name is not None:
+                index_names.add(index_name)
+            stack.extend(v for v in node.values() if type(v) is dict or type(v) is list)
+        elif type(node) is list:
+            stack.extend(v for v in node if type(v) is dict or type(v) is list)
     return list(index_names)
 
-@safe_execute
+def _write_shape(element, parts):
+    # Append a canonical token stream for element; dict keys are sorted
+    t = type(element)
+    if t is dict:
+        parts.append('{')
+        for k in sorted(element):
+            parts.append(_json_str(k))
+            parts.append(':')
+            _write_shape(element[k], parts)
+            parts.append(',')
+        parts.append('}')
+    elif t is list:
+        parts.append('[')
+        for item in element:
+            _write_shape(item, parts)
+            parts.append(',')
+        parts.append(']')
+    elif t is str and element.startswith('?'):
+        parts.append(_json_str(element))  # Preserve placeholder types
+    else:
+        parts.append(type(element).__name__)  # Use type name for non-placeholder values
+
 def hash_query_shape(query_shape):
     """
     Create a hash of the query shape, preserving structure and placeholder types.
     """
-    def _hash_element(element):
-        if isinstance(element, dict):
-            return json.dumps({k: _hash_element(v) for k, v in sorted(element.items())}, sort_keys=True)
-        elif isinstance(element, list):
-            return json.dumps([_hash_element(item) for item in element], sort_keys=True)
-        elif isinstance(element, str) and element.startswith('?'):
-            return element  # Preserve placeholder types
-        else:
-            return type(element).__name__  # Use type name for non-placeholder values
+    parts = []
+    _write_shape(query_shape, parts)
+    return hashlib.sha256(''.join(parts).encode()).hexdigest()
 
-    serialized = _hash_element(query_shape)
-    return hashlib.sha256(serialized.encode()).hexdigest()
+def query_shape_digest(query_shape):
+    """
+    Digest of the full query shape content, including namespace, command and sort.
+    Unlike hash_query_shape, shapes that differ in any value get different digests.
+    Key order is kept: the server reports a shape's fields in a stable order, and
+    sort specifications such as {a: 1, b: 1} and {b: 1, a: 1} are different shapes.
+    """
+    return hashlib.sha256(_shape_json(query_shape)).hexdigest()
 
 @safe_execute
 def correlate_queries(query_stats, query_settings):
     """
     Correlate queries from $queryStats with those in $querySettings using hash-based matching.
     """
-    # Hash all queries in $querySettings
-    settings_hash_map = {}
+    # Memoize hashes by object identity; the shape is kept alive alongside its hash
+    hash_cache = {}
+
+    def shape_hash(shape):
+        cached = hash_cache.get(id(shape))
+        if cached is None:
+            cached = hash_cache[id(shape)] = (shape, hash_query_shape(shape))
+        return cached[1]
+
+    # Hash all queries in $querySettings; hash -> position in settings_arr
+    settings_arr = []
+    hash_to_idx = {}
     for setting in query_settings:
         debug_shape = setting.get('debugQueryShape', {})
         query_shape = debug_shape.get('filter') or debug_shape.get('pipeline')
         if query_shape:
-            query_hash = hash_query_shape(query_shape)
-            settings_hash_map[query_hash] = setting
+            hash_to_idx[shape_hash(query_shape)] = len(settings_arr)
+            settings_arr.append(setting)
 
     # Correlate $queryStats queries with $querySettings
     correlated_queries = []
@@ -440,12 +504,11 @@ def correlate_queries(query_stats, query_settings):
         else:
             continue  # Skip unsupported commands
 
-        query_hash = hash_query_shape(shape_to_hash)
-        matching_setting = settings_hash_map.get(query_hash)
+        idx = hash_to_idx.get(shape_hash(shape_to_hash), -1)
 
         correlated_queries.append({
             'query_stat': stat,
-            'query_setting': matching_setting
+            'query_setting': settings_arr[idx] if idx >= 0 else None
         })
 
     return correlated_queries
\ No newline at end of file
@@ -1,9 +1,22 @@
 import streamlit as st
 import json
+import threading
+import uuid
 import extra_streamlit_components as stx
+from concurrent.futures import ThreadPoolExecutor
 from pymongo import MongoClient
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from mongodb_functions import *
 
+try:
+    import orjson
+
+    def show_json(body):
+        # Hand st.json a pre-serialized string so it skips its own json.dumps
+        st.json(orjson.dumps(body, default=repr, option=orjson.OPT_NON_STR_KEYS).decode())
+except ImportError:
+    show_json = st.json
+
 # Function to load and apply custom CSS
 def load_css():
     with open("style.css", "r") as f:
@@ -16,8 +29,122 @@ load_css()
 # Initialize cookie manager
 cookie_manager = stx.CookieManager()
 
+# Each browser session owns its client (kept in st.session_state across reruns),
+# so it can be closed on a deployment switch without affecting other sessions
+def get_mongo_client(connection_string):
+    # Compressors that are not installed are skipped by PyMongo with a warning
+    return MongoClient(connection_string,
+                       maxPoolSize=20,
+                       minPoolSize=2,
+                       serverSelectionTimeoutMS=3000,
+                       compressors='zstd,snappy,zlib',
+                       appName='QueryStatsAnalyzer')
+
+# Short-lived caches for metadata lookups so widget reruns skip the round trip.
+# Entries are keyed by the session's connection_id, issued afresh on every Connect, so a
+# reconnect reads new data without clearing other sessions' entries. The client itself
+# is passed unhashed (leading underscore).
+# Indexes are prefetched for every namespace on connect, so they are kept longer
+@st.cache_data(ttl=300, show_spinner=False)
+def cached_indexes(_client, connection_id, db_name, coll_name):
+    return get_indexes(_client, db_name, coll_name)
+
+def indexes_by_name(client, db_name, coll_name):
+    # Resolve index names from the same cached listIndexes result as the Indexes tab
+    return {index['name']: index
+            for index in cached_indexes(client, st.session_state.connection_id, db_name, coll_name) or []}
+
+@st.cache_data(ttl=30, show_spinner=False)
+def cached_debug_query_shapes(_client, connection_id, db_name, coll_name):
+    return get_debug_query_shapes(_client, db_name, coll_name)
+
+# Explain output depends only on the query shape, so cache it by the shape hash.
+# The leading underscores keep Streamlit from hashing the client and shape document.
+# The plan is cached together with everything derived from it, so reruns skip
+# walking the plan tree again.
+@st.cache_data(ttl=60, show_spinner=False)
+def cached_plan_bundle(_client, connection_id, shape_hash, _query_shape):
+    plan = get_explain_plan(_client, _query_shape)
+    if not plan:
+        return None
+    stages = get_plan_stages(plan) or []
+    winning_plan = plan.get('queryPlanner', {}).get('winningPlan', {})
+    collscan = has_collscan(stages)
+    return {
+        'stages': stages,
+        'winning_plan': winning_plan,
+        'indexes_used': extract_index_names(winning_plan),
+        'has_collscan': collscan,
+        # The suggestion depends only on the shape, so it is cached with the plan
+        'suggested_index': suggest_shape_index(_query_shape) if collscan else None
+    }
+
+@safe_execute
+def suggest_shape_index(query_shape):
+    command = query_shape.get('command')
+    filter_doc = query_shape.get('filter', {}) if command == 'find' else {}
+    if command == 'aggregate':
+        for stage in query_shape.get('pipeline', []):
+            if '$match' in stage:
+                filter_doc = stage['$match']
+                break
+    return suggest_index(filter_doc, query_shape.get('sort'))
+
+def shape_hash_for(entry):
+    # queryShapeHash is only reported by MongoDB 8.0+, so fall back to a digest of the full
+    # shape; hash_query_shape is too coarse here since it ignores namespace, command and sort
+    return entry.get('queryShapeHash') or query_shape_digest(entry['key']['queryShape'])
+
+# The rejection command is a pure function of the query shape
+@st.cache_data(max_entries=1000, show_spinner=False)
+def cached_rejection_filter(shape_hash, _query_shape):
+    if _query_shape.get('command') == 'find':
+        rep_query = create_representative_query(_query_shape.get('filter', {}))
+    else:  # aggregate
+        rep_query = create_representative_query(_query_shape.get('pipeline', []))
+    return create_rejection_filter(_query_shape, rep_query)
+
+# A namespace's $queryStats entries are fetched once per $queryStats summary (stats_version),
+# so the list and its order stay fixed while the user pages through it. The long TTL only
+# bounds how long an abandoned session's entries are kept.
+@st.cache_data(ttl=3600, show_spinner=False)
+def cached_namespace_query_stats(_client, connection_id, db_name, coll_name, stats_version):
+    return get_namespace_query_stats(_client, db_name, coll_name) or []
+
+# Correlation is redone when the $querySettings listing expires, against the same entries
+@st.cache_data(ttl=30, show_spinner=False)
+def cached_correlated_queries(_client, connection_id, db_name, coll_name, stats_version):
+    query_stats = cached_namespace_query_stats(_client, connection_id, db_name, coll_name, stats_version)
+    debug_shapes = cached_debug_query_shapes(_client, connection_id, db_name, coll_name)
+    return correlate_queries(query_stats, debug_shapes)
+
+def map_in_script_threads(fn, items, max_workers=8):
+    # Worker threads get the script context so cached functions can run in them
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(max_workers=max_workers,
+                            initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)) as executor:
+        return list(executor.map(fn, items))
+
+def fetch_explain_plans(client, entries, max_workers=8):
+    # Entries that differ only in client metadata share a query shape; explain each shape once
+    shape_hashes = [shape_hash_for(entry) for entry in entries]
+    shapes = {}
+    for shape_hash, entry in zip(shape_hashes, entries):
+        shapes.setdefault(shape_hash, entry['key']['queryShape'])
+
+    # Explains are independent and I/O-bound, so run them concurrently on the shared pool
+    connection_id = st.session_state.connection_id
+    bundles = dict(zip(shapes, map_in_script_threads(
+        lambda item: cached_plan_bundle(client, connection_id, *item), shapes.items(), max_workers)))
+    return [bundles[shape_hash] for shape_hash in shape_hashes]
+
+def prefetch_indexes(client, namespaces, max_workers=8):
+    # Warm the index cache for every namespace up front so switching namespaces skips the round trip
+    connection_id = st.session_state.connection_id
+    map_in_script_threads(lambda ns: cached_indexes(client, connection_id, *ns), namespaces, max_workers)
+
 @safe_execute
-def display_query_stat(client, entry, matching_setting, show_rejection_filter):
+def display_query_stat(client, entry, plan, matching_setting, show_rejection_filter):
     query_shape = entry['key']['queryShape']
     command = query_shape.get('command', 'Unknown')
     
@@ -28,84 +155,80 @@ def display_query_stat(client, entry, matching_setting, show_rejection_filter):
         
         if command == 'find':
             filter_content = query_shape.get('filter', {})
-            st.write("Filter:")
-            st.json(filter_content)
+            with st.expander("Filter", expanded=False):
+                show_json(filter_content)
         elif command == 'aggregate':
             pipeline = query_shape.get('pipeline', [])
-            st.write("Pipeline:")
-            st.json(pipeline)
+            with st.expander("Pipeline", expanded=False):
+                show_json(pipeline)
         else:
+            # No plan, index suggestion or rejection filter applies; skip the rest
             st.write("Unsupported command type")
+            st.markdown("---")
+            return
 
         # Display sort information if present
         sort = query_shape.get('sort')
         if sort:
             st.write("Sort:")
-            st.json(sort)
+            show_json(sort)
 
     with col2:
-        # Get and display plan stages
-        plan = get_explain_plan(client, entry)
+        # Collect the per-entry documents into one JSON panel, so each entry sends a
+        # single expander and JSON element to the frontend instead of one per section
+        details = {}
         if plan:
-            stages = get_plan_stages(plan)
-            with st.expander("Plan Stages", expanded=False):
-                st.json(stages)
-            
-            # Display Winning Plan
-            winning_plan = plan.get('queryPlanner', {}).get('winningPlan', {})
-            with st.expander("Winning Plan", expanded=False):
-                st.json(winning_plan)
-            
-            # Extract and display Indexes Used
-            indexes_used = extract_index_names(winning_plan)
+            details['Plan Stages'] = plan['stages']
+            details['Winning Plan'] = plan['winning_plan']
+
+            indexes_used = plan['indexes_used']
             if indexes_used:
-                with st.expander("Indexes Used", expanded=False):
-                    for index_name in indexes_used:
-                        index_info = get_index_info(client, query_shape['cmdNs']['db'], 
-                                                    query_shape['cmdNs']['coll'], index_name)
-                        if index_info:
-                            st.json(index_info)
-                        else:
-                            st.write(f"Index information not found for: {index_name}")
-            
+                index_map = indexes_by_name(client, query_shape['cmdNs']['db'], query_shape['cmdNs']['coll'])
+                details['Indexes Used'] = {
+                    index_name: index_map.get(index_name, "Index information not found")
+                    for index_name in indexes_used
+                }
+
             # Suggest index if COLLSCAN is present
-            if has_collscan(stages):
-                filter_doc = query_shape.get('filter', {}) if command == 'find' else {}
-                if command == 'aggregate':
-                    for stage in query_shape.get('pipeline', []):
-                        if '$match' in stage:
-                            filter_doc = stage['$match']
-                            break
-                suggested_index = suggest_index(filter_doc, sort)
-                with st.expander("Suggested Index", expanded=False):
-                    st.json(suggested_index)
-
-        with st.expander("Client Details", expanded=False):
-            st.json(entry['key']['client'])
-
-        with st.expander("Metrics", expanded=False):
-            st.json(entry['metrics'])
-
-        # Display matching Query Settings if available
+            if plan['has_collscan']:
+                details['Suggested Index'] = plan['suggested_index']
+
+        details['Client Details'] = entry['key']['client']
+        details['Metrics'] = entry['metrics']
+
+        # Include matching Query Settings if available
         if matching_setting:
-            with st.expander("Query Settings", expanded=False):
-                st.json(matching_setting)
-
-        # Create and display Rejection Filter if MongoDB version is 8+ and not already rejected
-        if (show_rejection_filter and command in ['find', 'aggregate'] and 
-            not (matching_setting and matching_setting.get('settings', {}).get('reject', False))):
-            if command == 'find':
-                rep_query = create_representative_query(query_shape.get('filter', {}))
-            else:  # aggregate
-                rep_query = create_representative_query(query_shape.get('pipeline', []))
-            
-            rejection_filter = create_rejection_filter(query_shape, rep_query)
+            details['Query Settings'] = matching_setting
+
+        with st.expander("Plan, Metrics and Settings", expanded=False):
+            show_json(details)
+
+        # Create and display Rejection Filter if MongoDB version is 8+ and not already rejected.
+        # Unsupported commands have already returned, so only find/aggregate reach here.
+        already_rejected = bool(matching_setting) and matching_setting.get('settings', {}).get('reject', False)
+        if show_rejection_filter and not already_rejected:
+            rejection_filter = cached_rejection_filter(shape_hash_for(entry), query_shape)
             
             with st.expander("Rejection Filter Mongosh Command", expanded=False):
                 st.code(rejection_filter, language="javascript")
 
     st.markdown("---")  # Add a dividing line
 
+def start_connection():
+    # A new connection_id makes this session's cached server data miss, while other
+    # sessions keep theirs; stale entries age out through their TTLs.
+    st.session_state.connection_id = uuid.uuid4().hex
+    st.session_state.query_stats = None
+    st.session_state.namespace_options = []
+
+def store_query_stats(query_stats):
+    st.session_state.query_stats = query_stats
+    st.session_state.stats_version = st.session_state.get('stats_version', 0) + 1
+    # Build the (namespace, label) selector options once per fetch, not on every rerun.
+    # Counts are capped like the per-namespace fetch, so the label matches the tab.
+    st.session_state.namespace_options = [(ns, f"{ns[0]}.{ns[1]} ({min(count, NAMESPACE_QUERY_STATS_LIMIT)})")
+                                          for ns, count in (query_stats or {}).items()]
+
 def connection_dialog():
     with st.sidebar:
         st.subheader("MongoDB Connection")
@@ -116,8 +239,16 @@ def connection_dialog():
         
         if st.button("Connect"):
             try:
-                client = MongoClient(connection_string)
+                start_connection()
+                client = st.session_state.get('client')
+                if client is not None and st.session_state.get('connection_string') != connection_string:
+                    # Switching deployments: release this session's connection pool
+                    client.close()
+                    client = st.session_state.client = None
+                if client is None:
+                    client = get_mongo_client(connection_string)
                 st.session_state.client = client
+                st.session_state.connection_string = connection_string
                 st.session_state.mongodb_version = get_mongodb_version(client)
                 st.session_state.connected = True
                 st.session_state.connection_error = None
@@ -134,7 +265,10 @@ def connection_dialog():
                     if query_stats_result["error"] == "rate_limit_zero":
                         st.session_state.rate_limit = 0
                 else:
-                    st.session_state.query_stats = query_stats_result
+                    store_query_stats(query_stats_result)
+                    # get_query_stats returns None when $queryStats fails; there is nothing to prefetch then
+                    if query_stats_result:
+                        prefetch_indexes(client, query_stats_result)
                     st.session_state.query_stats_error = None
                     st.session_state.rate_limit = None  # Reset rate_limit if query stats are successfully retrieved
                 
@@ -182,7 +316,9 @@ def main():
                         st.session_state.query_stats_error = query_stats_result["error"]
                         st.session_state.query_stats = None
                     else:
-                        st.session_state.query_stats = query_stats_result
+                        store_query_stats(query_stats_result)
+                        if query_stats_result:
+                            prefetch_indexes(st.session_state.client, query_stats_result)
                         st.session_state.query_stats_error = None
                         st.session_state.rate_limit = None
                 except Exception as e:
@@ -195,39 +331,58 @@ def main():
     if st.session_state.connected and st.session_state.query_stats and not st.session_state.query_stats_error:
         try:
             # Create dropdown for namespace selection
-            namespaces = list(st.session_state.query_stats.keys())
-            namespace_options = [f"{ns} ({len(st.session_state.query_stats[ns])})" for ns in namespaces]
-            selected_option = st.selectbox("Select Namespace", namespace_options)
+            selected_option = st.selectbox("Select Namespace", st.session_state.namespace_options,
+                                           format_func=lambda option: option[1])
             
             if selected_option:
-                selected_namespace = selected_option.split(" (")[0]
-                db_name, coll_name = selected_namespace.split('.')
+                db_name, coll_name = selected_option[0]
                 
                 # Create tabs for different views
                 tab1, tab2, tab3 = st.tabs(["$queryStats", "Indexes", "$querySettings"])
                 
                 with tab1:
                     st.subheader("$queryStats")
-                    debug_shapes = get_debug_query_shapes(st.session_state.client, db_name, coll_name)
-                    correlated_queries = correlate_queries(st.session_state.query_stats[selected_namespace], debug_shapes)
+                    correlated_queries = cached_correlated_queries(st.session_state.client, st.session_state.connection_id,
+                                                                   db_name, coll_name,
+                                                                   st.session_state.stats_version)
+
+                    # The per-namespace fetch keeps only the most executed entries
+                    total_entries = st.session_state.query_stats.get((db_name, coll_name), 0)
+                    if total_entries > NAMESPACE_QUERY_STATS_LIMIT:
+                        st.info(f"Showing the {NAMESPACE_QUERY_STATS_LIMIT} most executed of "
+                                f"{total_entries} $queryStats entries for this namespace.")
+
+                    # Only explain and render one page of entries per rerun, unless all are requested
+                    if not st.checkbox("Show all entries", value=False):
+                        page_col1, page_col2 = st.columns(2)
+                        with page_col1:
+                            page_size = st.number_input("Entries per page", min_value=10, max_value=200, value=25, step=5)
+                        page_count = max(1, -(-len(correlated_queries) // page_size))
+                        with page_col2:
+                            page = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1, step=1)
+                        correlated_queries = correlated_queries[(page - 1) * page_size:page * page_size]
+
+                    plans = fetch_explain_plans(st.session_state.client,
+                                                [correlated_query['query_stat'] for correlated_query in correlated_queries])
                     
-                    for correlated_query in correlated_queries:
-                        display_query_stat(st.session_state.client, correlated_query['query_stat'], 
+                    for correlated_query, plan in zip(correlated_queries, plans):
+                        display_query_stat(st.session_state.client, correlated_query['query_stat'], plan,
                                            correlated_query['query_setting'], 
                                            st.session_state.mongodb_version >= 8)
                 
                 with tab2:
                     st.subheader("Indexes")
-                    indexes = get_indexes(st.session_state.client, selected_namespace)
+                    indexes = cached_indexes(st.session_state.client, st.session_state.connection_id, db_name, coll_name)
                     for index in indexes:
-                        st.json(index)
+                        show_json(index)
                 
                 with tab3:
                     st.subheader("$querySettings")
                     if st.session_state.mongodb_version >= 8:
-                        debug_shapes = get_debug_query_shapes(st.session_state.client, db_name, coll_name)
+                        debug_shapes = cached_debug_query_shapes(st.session_state.client, st.session_state.connection_id,
+                                                                 db_name, coll_name)
                         for shape in debug_shapes:
-                            st.json(shape)
+                            show_json(shape)
                     else:
                         st.info("$querySettings is only available in MongoDB 8.0 and above.")
         except Exception as e:
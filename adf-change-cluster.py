@@ -1,14 +1,80 @@
 import requests
+import copy
 import json
 import os
 import sys
 import argparse
+import functools
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPDigestAuth
+from urllib3.util.retry import Retry
 
 # Load environment variables from .env file
 load_dotenv()
 
+# One keep-alive session for all Atlas API calls, retrying rate limits and transient server errors.
+# The PATCH sends the complete configuration, so repeating it is safe.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(total=5, backoff_factor=0.5,
+                      status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=["GET", "PATCH"],
+                      raise_on_status=False)
+))
+
+@functools.lru_cache(maxsize=None)
+def get_digest_auth(public_key, private_key):
+    # Reuse one auth object per key pair so the digest nonce carries over between calls
+    return HTTPDigestAuth(public_key, private_key)
+
+# Fields of the current federation configuration that are sent back unchanged
+FEDERATION_FIELDS = frozenset(['cloudProviderConfig', 'dataProcessRegion', 'name'])
+
+# Storage configuration mapping every database and collection to the cluster store.
+# The store name, cluster name and project ID are filled in by build_storage_config.
+STORAGE_TEMPLATE = {
+    "databases": [
+        {
+            "collections": [
+                {
+                    "dataSources": [
+                        {
+                            "storeName": None
+                        }
+                    ],
+                    "name": "*"
+                }
+            ],
+            "name": "*",
+            "views": []
+        }
+    ],
+    "stores": [
+        {
+            "provider": "atlas",
+            "clusterName": None,
+            "name": None,
+            "projectId": None,
+            "readPreference": {
+                "mode": "secondary",
+                "tagSets": []
+            }
+        }
+    ]
+}
+
+def build_storage_config(cluster_name, project_id):
+    storage = copy.deepcopy(STORAGE_TEMPLATE)
+    storage['databases'][0]['collections'][0]['dataSources'][0]['storeName'] = cluster_name
+    store = storage['stores'][0]
+    store['clusterName'] = cluster_name
+    store['name'] = cluster_name
+    store['projectId'] = project_id
+    return storage
+
 def get_data_federation_instance_details(public_key, private_key, project_id, tenant_name, cluster_name):
     # Atlas API endpoint (v2)
     url = f"https://cloud.mongodb.com/api/atlas/v2/groups/{project_id}/dataFederation/{tenant_name}"
@@ -19,11 +85,11 @@ def get_data_federation_instance_details(public_key, private_key, project_id, te
     }
 
     # Set up digest authentication
-    auth = HTTPDigestAuth(public_key, private_key)
+    auth = get_digest_auth(public_key, private_key)
 
     try:
         # Make the API request
-        response = requests.get(url, headers=headers, auth=auth)
+        response = SESSION.get(url, headers=headers, auth=auth)
 
         # Check if the request was successful
         if response.status_code == 200:
@@ -32,42 +98,13 @@ def get_data_federation_instance_details(public_key, private_key, project_id, te
             
             # Filter the JSON to include only the specified fields
             filtered_details = {
-                key: federation_details[key]
-                for key in ['cloudProviderConfig', 'dataProcessRegion', 'name']
-                if key in federation_details
+                key: value
+                for key, value in federation_details.items()
+                if key in FEDERATION_FIELDS
             }
             
             # Add the new storage configuration
-            filtered_details['storage'] = {
-                "databases": [
-                    {
-                        "collections": [
-                            {
-                                "dataSources": [
-                                    {
-                                        "storeName": cluster_name
-                                    }
-                                ],
-                                "name": "*"
-                            }
-                        ],
-                        "name": "*",
-                        "views": []
-                    }
-                ],
-                "stores": [
-                    {
-                        "provider": "atlas",
-                        "clusterName": cluster_name,
-                        "name": cluster_name,
-                        "projectId": project_id,
-                        "readPreference": {
-                            "mode": "secondary",
-                            "tagSets": []
-                        }
-                    }
-                ]
-            }
+            filtered_details['storage'] = build_storage_config(cluster_name, project_id)
             
             return filtered_details
         else:
@@ -89,11 +126,11 @@ def update_data_federation_instance(public_key, private_key, project_id, tenant_
     }
 
     # Set up digest authentication
-    auth = HTTPDigestAuth(public_key, private_key)
+    auth = get_digest_auth(public_key, private_key)
 
     try:
         # Make the PATCH API request
-        response = requests.patch(url, headers=headers, auth=auth, json=updated_config)
+        response = SESSION.patch(url, headers=headers, auth=auth, json=updated_config)
 
         # Check if the request was successful
         if response.status_code == 200: